@@ -1,15 +1,24 @@
 import os
+import logging
 import time
 import struct
 import signal
 
+# solver message header (body length, type), incumbent update message
+# and the objective value leading incumbent and result bodies
+HEADER = struct.Struct('>HB')
+INCUMBENT = struct.Struct('>HBd')
+VALUE = struct.Struct('>d')
+
+log = logging.getLogger('everest.port_proxy')
+
 def readExact(fd, l):
     bufs = []
     while l > 0:
         try:
             buf = os.read(fd, l)
         except KeyboardInterrupt:
-            print 'port_proxy: KeyboardInterrupt received'
+            log.info('port_proxy: KeyboardInterrupt received')
             continue
         if not buf:
             break
@@ -18,7 +27,7 @@ def readExact(fd, l):
     return ''.join(bufs)
 
 def sendIncumbent((_, fd, cpid), value):
-    msg = struct.pack('>HBd', 9, 1, value)
+    msg = INCUMBENT.pack(9, 1, value)
     wr = os.write(fd, msg)
     #assert(wr == len(msg))
 
@@ -35,29 +44,30 @@ def startSolver(args):
         os.close(proxy2solverWrite)
         os.dup2(solver2proxyWrite, 4)
         os.dup2(proxy2solverRead, 3)
-        print 'Starting solver', args[0], args
         os.execvp(args[0], args)
     signal.signal(signal.SIGINT, old)
+    log.info('Started solver %s %s', args[0], args)
     os.close(solver2proxyWrite)
     os.close(proxy2solverRead)
     return (solver2proxyRead, proxy2solverWrite, cpid)
 
 def readFromSolver((solver2proxyRead, _, cpid)):
-    buf = readExact(solver2proxyRead, 3)
+    buf = readExact(solver2proxyRead, HEADER.size)
     if not buf:
         p, exitcode = os.waitpid(cpid, 0)
         return 'closed', exitcode
-    bodyLen, msgType = struct.unpack('>HB', buf)
+    bodyLen, msgType = HEADER.unpack(buf)
     buf = readExact(solver2proxyRead, bodyLen-1)
     if msgType == 3:
-        incumbent, = struct.unpack('>d', buf)
+        incumbent, = VALUE.unpack(buf)
         return 'incumbent', incumbent
     elif msgType == 2:
-        statusLen = bodyLen - 9
-        incumbent, status = struct.unpack('>d%ds' % statusLen, buf)
+        incumbent, = VALUE.unpack_from(buf)
+        status = buf[VALUE.size:]
         return 'result', incumbent, status
 
 def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     solver = startSolver(['../c_src/cbc_port', '../test/BalanceTestDyn.nl',
                           '-p'])#, '-q', '-o', 'test.log'])
 
@@ -1,25 +1,42 @@
 import sys
 import os
+import errno
+import logging
+import select
 import socket
 import struct
 import random
-import threading
 import time
 
 import port_proxy
 
-def recvExact(sock, l):
-    bufs = []
-    while l > 0:
+log = logging.getLogger('everest.task')
+
+# message length header and the initial (length, mode) header
+HEADER = struct.Struct('>I')
+INIT_HEADER = struct.Struct('>Ib')
+
+# delay between repeated SIGINTs to a solver that does not stop
+KILL_DELAY = 1
+
+# socket errors meaning that the agent has gone away
+AGENT_GONE = (errno.ECONNRESET, errno.EPIPE)
+
+# how long to wait for the agent to close the connection after the solver exits
+DRAIN_TIMEOUT = 0.5
+
+class BufferedStreamHandler(logging.StreamHandler):
+    # StreamHandler flushes after every record; this one leaves it to
+    # flushLog(), which is called before blocking on the agent or solver
+    def emit(self, record):
         try:
-            buf = sock.recv(l)
-            if not buf:
-                break
-            l -= len(buf)
-            bufs.append(buf)
-        except socket.timeout:
-            pass
-    return ''.join(bufs)
+            self.stream.write(self.format(record) + '\n')
+        except Exception:
+            self.handleError(record)
+
+def flushLog():
+    for handler in logging.getLogger().handlers:
+        handler.flush()
 
 class Task:
 
@@ -33,29 +50,34 @@ class Task:
         # connect to agent
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((address, port))
-        print 'Connected to agent, setting message mode'
-        self.sock.sendall(struct.pack('>Ib', len(task_id) + 1, 0))
-        self.sock.sendall(task_id)
-        self.sock.settimeout(0.5)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        log.info('Connected to agent, setting message mode')
+        self.sock.sendall(INIT_HEADER.pack(len(task_id) + 1, 0) + task_id)
+        # receive buffer reused by all messages, grown on demand;
+        # bytes between recvStart and recvEnd are received but not consumed
+        self.recvBuf = bytearray(4096)
+        self.recvView = memoryview(self.recvBuf)
+        self.recvStart = 0
+        self.recvEnd = 0
         self.running = True
+        self.agentClosed = False
+        self.killing = False
+        self.nextKill = None
 
-    def requestVar(self, name):
-        msg = "VAR_GET %s" % name
-        self.send_message(msg)
+    def requestVars(self, *names):
+        self.send_messages(["VAR_GET %s" % name for name in names])
 
     def requestAndWaitVars(self):
-        self.requestVar(self.stoppedVar)
-        self.requestVar('record')
+        self.requestVars(self.stoppedVar, 'record')
+        expected = set([self.stoppedVar, 'record'])
         values = {}
         while True:
-            try:
-                resp = self.receive_message()
-            except socket.timeout:
-                continue
+            resp = self.receive_message()
             assert resp, 'Server connection closed'
-            if not resp.split()[1] in [self.stoppedVar, 'record']:
+            parts = resp.split(None, 2)
+            if len(parts) < 3 or parts[0] != 'VAR_VALUE' or not parts[1] in expected:
                 continue
-            values[resp.split()[1]] = resp.split()[2]
+            values[parts[1]] = parts[2]
             if len(values) == 2:
                 break
         return values
@@ -69,7 +91,12 @@ class Task:
         args = [solver, stub, '-p']
         # time.sleep(random.uniform(1, 10))
 
-        self.stoppedVar = os.path.splitext(stub)[0] + '_stopped'
+        stubBase = os.path.splitext(stub)[0]
+        solPath = stubBase + '.sol'
+        self.stoppedVar = stubBase + '_stopped'
+        self.handlers = {('VAR_VALUE', 'record'): self.on_record}
+        if self.stopMode:
+            self.handlers[('VAR_VALUE', self.stoppedVar)] = self.on_stopped
 
         # get current record and stop state
         vals = self.requestAndWaitVars()
@@ -77,7 +104,7 @@ class Task:
         stopped = vals[self.stoppedVar] != 'NULL'
         if self.stopMode and stopped:
             self.sock.shutdown(socket.SHUT_WR)
-            os.mknod(os.path.splitext(stub)[0] + '.sol')
+            os.mknod(solPath)
             return
 
         cur_record = vals['record']
@@ -89,95 +116,221 @@ class Task:
             args.append('%g' % initialIncumbent)
 
         with open(paramsFile, 'r') as f:
-            otherArgs = f.read().split('\n')
+            otherArgs = [l for l in f.read().split('\n') if l.strip()]
         if otherArgs:
             args.append('--')
             args.extend(otherArgs)
 
+        # don't let the forked child inherit unwritten log records
+        flushLog()
         self.solver = port_proxy.startSolver(args)
+        solverFd = self.solver[0]
 
-        # receive record updates in a separate thread
-        receiver = threading.Thread(target=self.receive_records)
-        receiver.start()
-
+        # serve both the agent socket and the solver pipe from one loop
         hadSmth = False
         while self.running:
+            if not self.agentClosed and self.message_buffered():
+                # an earlier read already brought in the next message
+                ready = [self.sock]
+            else:
+                timeout = None
+                if self.killing:
+                    timeout = max(0, self.nextKill - time.time())
+                watched = [solverFd]
+                if not self.agentClosed:
+                    watched.append(self.sock)
+                flushLog()
+                try:
+                    ready, _, _ = select.select(watched, [], [], timeout)
+                except KeyboardInterrupt:
+                    log.info('task: KeyboardInterrupt received')
+                    continue
+            # retry the stop on schedule even if messages keep arriving
+            if self.killing:
+                now = time.time()
+                if now >= self.nextKill:
+                    self.nextKill = now + KILL_DELAY
+                    port_proxy.stopSolver(self.solver)
+                    log.info('Sent SIGINT to solver')
+            if not ready:
+                continue
+            if self.sock in ready:
+                if not self.process_message():
+                    self.agent_closed()
+            if not solverFd in ready:
+                continue
             solverMsg = port_proxy.readFromSolver(self.solver)
             if solverMsg[0] in ['incumbent', 'result']:
                 hadSmth = True
-                print "Found new record: %f" % solverMsg[1]
-                msg = "VAR_SET_MD record %f" % solverMsg[1]
-                self.send_message(msg)
+                log.info('Found new record: %f', solverMsg[1])
+                self.send_update("VAR_SET_MD record %f" % solverMsg[1])
                 if solverMsg[0] == 'result':
-                    with open(os.path.splitext(stub)[0] + '.sol', 'r') as f:
-                        firstLine = f.readline()
+                    with open(solPath, 'r') as f:
+                        firstLine = f.readline(256)
                     sys.stderr.write(">>> solutionHeader: %s\n" % firstLine)
-                if self.stopMode and solverMsg[0] == 'result':
-                    print 'Got result, stopping other solvers...'
-                    self.send_message('VAR_SET_MD %s 1' % self.stoppedVar)
+                if self.stopMode and solverMsg[0] == 'result' and not self.agentClosed:
+                    log.info('Got result, stopping other solvers...')
+                    self.send_update('VAR_SET_MD %s 1' % self.stoppedVar)
             elif solverMsg[0] == 'closed':
                 if not hadSmth:
-                    print 'Warning: No data from solver received'
+                    log.warning('Warning: No data from solver received')
                 self.running = False
-                self.sock.shutdown(socket.SHUT_WR)
-                receiver.join()
                 sys.stderr.write(">>> solver_exitcode: %s\n" % solverMsg[1])
-                print 'Finished', solverMsg
+                if not self.agentClosed:
+                    self.drain()
+                log.info('Finished %s', solverMsg)
                 return solverMsg[1]
         return 0
 
     def send_message(self, msg):
-        self.sock.sendall(struct.pack('>I', len(msg)))
-        self.sock.sendall(msg)
+        self.sock.sendall(HEADER.pack(len(msg)) + msg)
+
+    def send_update(self, msg):
+        if self.agentClosed:
+            return
+        try:
+            self.send_message(msg)
+        except socket.error as e:
+            if e.errno not in AGENT_GONE:
+                raise
+            self.agent_closed()
+
+    def agent_closed(self):
+        # keep serving the solver to collect its exit code
+        log.warning('Agent closed the connection')
+        self.agentClosed = True
+
+    def send_messages(self, msgs):
+        # coalesce several framed messages into one write
+        buf = bytearray()
+        for msg in msgs:
+            buf += HEADER.pack(len(msg))
+            buf += msg
+        self.sock.sendall(buf)
+
+    def fill_buffer(self, need):
+        # read as much as fits, so that header and body of a message
+        # usually arrive in a single recv
+        if self.recvStart + need > len(self.recvBuf):
+            pending = self.recvView[self.recvStart:self.recvEnd].tobytes()
+            if need > len(self.recvBuf):
+                self.recvBuf = bytearray(max(need, 2 * len(self.recvBuf)))
+                self.recvView = memoryview(self.recvBuf)
+            self.recvBuf[:len(pending)] = pending
+            self.recvStart = 0
+            self.recvEnd = len(pending)
+        while self.recvEnd - self.recvStart < need:
+            flushLog()
+            try:
+                n = self.sock.recv_into(self.recvView[self.recvEnd:])
+            except socket.error as e:
+                # a reset means the agent is gone, same as a clean close
+                if e.errno not in AGENT_GONE:
+                    raise
+                return False
+            if not n:
+                return False
+            self.recvEnd += n
+        return True
+
+    def message_buffered(self):
+        available = self.recvEnd - self.recvStart
+        if available < HEADER.size:
+            return False
+        size, = HEADER.unpack_from(self.recvBuf, self.recvStart)
+        return available >= HEADER.size + size
 
     def receive_message(self):
-        header = recvExact(self.sock, 4)
-        if not header:
+        if not self.fill_buffer(HEADER.size):
             return ''
-        size, = struct.unpack('>I', header)
-        msg = recvExact(self.sock, size)
-        print "%s Received message: %s" % (time.ctime(), msg)
+        size, = HEADER.unpack_from(self.recvBuf, self.recvStart)
+        if not self.fill_buffer(HEADER.size + size):
+            return ''
+        start = self.recvStart + HEADER.size
+        msg = self.recvView[start:start + size].tobytes()
+        self.recvStart = start + size
+        if self.recvStart == self.recvEnd:
+            self.recvStart = self.recvEnd = 0
+        log.info('Received message: %.80s', msg)
         return msg
 
-    def receive_records(self):
-        killing = False
-        nextKill = None
-        killDelay = 1
-        while self.running:
-            try:
-                msg = self.receive_message()
-                if not msg:
-                    self.running = False
+    def drain(self):
+        # read what the agent still sends (e.g. the echo of our stop
+        # message) until it closes the connection; the solver is gone,
+        # so messages are only logged, not dispatched
+        deadline = time.time() + DRAIN_TIMEOUT
+        try:
+            self.sock.shutdown(socket.SHUT_WR)
+            while True:
+                if not self.message_buffered():
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    flushLog()
+                    ready, _, _ = select.select([self.sock], [], [], timeout)
+                    if not ready:
+                        break
+                if not self.receive_message():
                     break
-                if msg.startswith('VAR_VALUE record'):
-                    record = float(msg.split()[2])
-                    port_proxy.sendIncumbent(self.solver, record)
-                    print "Updated record: %f" % record
-                elif self.stopMode and msg.startswith('VAR_VALUE %s' % self.stoppedVar):
-                    assert(msg.split()[2] == '1')
-                    killing = True
-                    nextKill = time.time() + killDelay
-                    print "Got stop message. Stopping solver..."
-                    port_proxy.stopSolver(self.solver)
-                    print "Sent SIGINT to solver"
-                elif self.stopMode and msg.startswith('VAR_VALUE') and 'stopped' in msg:
-                    print 'Got stopped message for other stub:', msg
-                else:
-                    assert False, 'Unknown message: %s' % msg
-            except socket.timeout:
-                if killing and time.time() >= nextKill:
-                    nextKill = time.time() + killDelay
-                    port_proxy.stopSolver(self.solver)
-                    print "Sent SIGINT to solver"
-            except:
-                self.running = False
+        except (socket.error, select.error, KeyboardInterrupt) as e:
+            log.info('Stopped reading from agent: %r', e)
+
+    def process_message(self):
+        msg = self.receive_message()
+        if not msg:
+            return False
+        # split off only the tag, the value may be long
+        parts = msg.split(None, 2)
+        if len(parts) < 3:
+            handler = self.on_unknown
+        else:
+            handler = self.handlers.get(tuple(parts[:2]), self.on_unknown)
+        handler(msg, parts)
+        return True
+
+    def on_record(self, msg, parts):
+        try:
+            record = float(parts[2])
+        except ValueError:
+            log.warning('Bad record value: %.80s', parts[2])
+            return
+        try:
+            port_proxy.sendIncumbent(self.solver, record)
+        except OSError as e:
+            # the solver may have exited already, its exit code is
+            # picked up from the pipe on the next iteration
+            if e.errno != errno.EPIPE:
                 raise
+        log.info('Updated record: %f', record)
+
+    def on_stopped(self, msg, parts):
+        if parts[2] != '1':
+            log.warning('Bad stop value: %.80s', parts[2])
+            return
+        self.killing = True
+        self.nextKill = time.time() + KILL_DELAY
+        log.info('Got stop message. Stopping solver...')
+        port_proxy.stopSolver(self.solver)
+        log.info('Sent SIGINT to solver')
+
+    def on_unknown(self, msg, parts):
+        if (self.stopMode and len(parts) == 3 and parts[0] == 'VAR_VALUE'
+                and parts[1].endswith('_stopped')):
+            log.info('Got stopped message for other stub: %s', msg)
+        else:
+            log.warning('Unknown message (%d bytes): %.80s', len(msg), msg)
 
     def shutdown(self):
         self.running = False
         self.sock.close()
 
 def main():
+    # stdout is unbuffered under run-task.sh (python -u), so log through
+    # a separately buffered file object on the same descriptor
+    handler = BufferedStreamHandler(os.fdopen(os.dup(sys.stdout.fileno()), 'w', 1 << 16))
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logging.getLogger().addHandler(handler)
+    logging.getLogger().setLevel(logging.INFO)
     task = Task()
     try:
         return task.run()